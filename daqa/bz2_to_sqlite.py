@@ -1,13 +1,25 @@
 import bz2
+import io
 import sqlite3
-import xml.etree.ElementTree as ET
 
+from lxml import etree
 from tqdm import tqdm
 
+# Read-ahead buffer between the bz2 decompressor and the XML parser
+BUFFER_SIZE = 256 * 1024
+# Number of articles inserted per transaction
+BATCH_SIZE = 1000
+
+# The XML namespace of the MediaWiki export format
+NS = '{http://www.mediawiki.org/xml/export-0.11/}'
+
 
 def preprocess_wikipedia_dump(bz2_file_path, db_file_path):
     conn = sqlite3.connect(db_file_path)
     cursor = conn.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute('PRAGMA temp_store=MEMORY')
 
     # Create table for articles
     cursor.execute('''
@@ -18,31 +30,35 @@ def preprocess_wikipedia_dump(bz2_file_path, db_file_path):
     )
     ''')
 
-    # Define the XML namespace
-    ns = {'wiki': 'http://www.mediawiki.org/xml/export-0.11/'}
+    batch = []
+
+    raw = bz2.BZ2File(bz2_file_path, 'rb')
+    buf = io.BufferedReader(raw, buffer_size=BUFFER_SIZE)
+    with buf as file:
+        context = etree.iterparse(file, events=('end',), tag=NS + 'page')
 
-    with bz2.open(bz2_file_path, 'rt', encoding='utf-8') as file:
-        context = ET.iterparse(file, events=('end',))
-        
         # Use tqdm to show progress
         with tqdm(desc="Processing articles") as pbar:
             for event, elem in context:
-                if elem.tag.endswith('page'):
-                    title_elem = elem.find('.//wiki:title', namespaces=ns)
-                    text_elem = elem.find('.//wiki:text', namespaces=ns)
-                    
-                    if title_elem is not None and text_elem is not None:
-                        title = title_elem.text
-                        content = text_elem.text
-                        
-                        if title and content:
-                            cursor.execute('INSERT INTO articles (title, content) VALUES (?, ?)', (title, content))
-                            conn.commit()
-                            pbar.update(1)
-                    
-                    # Clear the element to free up memory
-                    elem.clear()
+                title = elem.findtext(NS + 'title')
+                content = elem.findtext(NS + 'revision/' + NS + 'text')
+
+                if title and content:
+                    batch.append((title, content))
+                    if len(batch) >= BATCH_SIZE:
+                        cursor.executemany('INSERT INTO articles (title, content) VALUES (?, ?)', batch)
+                        conn.commit()
+                        batch.clear()
+                    pbar.update(1)
+
+                # Clear the element and its processed siblings to free up memory
+                elem.clear(keep_tail=False)
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
 
+    if batch:
+        cursor.executemany('INSERT INTO articles (title, content) VALUES (?, ?)', batch)
+    conn.commit()
     conn.close()
 
 if __name__ == '__main__':
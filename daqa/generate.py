@@ -1,30 +1,108 @@
 import argparse
+import asyncio
+import collections
 import hashlib
-import json
 import logging
 import os
 import random
 import re
 import sqlite3
-import time
 
 import datasets
 import mwparserfromhell
+import openai
+import orjson
+import pyarrow as pa
+import pyarrow.parquet as pq
 from dotenv import load_dotenv
 from huggingface_hub import HfApi
-from openai import OpenAI
+from openai import AsyncOpenAI
 from tqdm import tqdm
 
+from daqa.qa_cache import QACache
+from daqa.semantic_cache import SemanticCache
+
 load_dotenv()
-client = OpenAI()
+# Retries are handled in generate_questions
+client = AsyncOpenAI(max_retries=0)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
+# Templates, categories, external links, comments and references are removed in
+# one pass. Wikilinks are replaced by their label in a second pass, as labels may
+# contain templates and references that must be removed first
+_RE_STRIP = re.compile(
+    r'{{[^}]*}}'
+    r'|\[\[Kategori:[^\]]*\]\]'
+    r'|\[http[^\]]*\]'
+    r'|<!--.*?-->'
+    r'|<ref[^>]*>.*?</ref>',
+    re.DOTALL,
+)
+_RE_WIKILINK = re.compile(r'\[\[(?:[^|\]]*\|)?([^\]]+)\]\]')
+_RE_ONLY_TEMPLATES_AND_CATS = re.compile(r'(?:{{[^}]*}}|\[\[Kategori:[^\]]*\]\]|\s)*')
+_RE_INCLUDE_ONLY_TEMPLATES = re.compile(
+    r'{{\s*(?:'
+    r'(?P<include>Include only|Kun til inklusion)'
+    r'|(?P<navbox>navbox|infoboks|Infoboks)'
+    r'|(?P<table>tabel|Table)'
+    r')',
+    re.IGNORECASE,
+)
+_RE_JSON_LIST = re.compile(r'\[.*?\]', re.DOTALL)
+
+# Minimum size of a cleaned article
+MIN_CONTENT_LENGTH = 500
+MIN_WORD_COUNT = 70
+
+# Number of content characters sent to the model
+MAX_CONTENT_CHARS = 8000
+# Bump when the prompts change to invalidate the cache
+PROMPT_VERSION = 'v1'
+
+QA_SCHEMA = pa.schema([
+    ('title', pa.string()),
+    ('context', pa.large_string()),
+    ('question', pa.string()),
+    ('answer', pa.string()),
+])
+# Number of Q&A rows buffered before they are written to disk
+WRITE_BATCH_SIZE = 10_000
+
+SYSTEM_MESSAGE = {"role": "system", "content": "You are a helpful assistant that generates questions and answers based on given content in Danish."}
+HARD_PROMPT = """
+        Givet følgende Wikipedia-artikel, skal du generere 3 spørgsmål og deres svar baseret på indholdet. 
+        Svaret skal kunne udledes fra information i artiklen, ved brug af almindelig viden og logik. Svaret skal være et par ord eller højest en kort sætning.
+        Spørgsmålene skal være udfordrende, svarene må ikke stå direkte i artiklen. Der skal gerne bruges 2-3 logiske trin til at udlede svaret.
+        Det kunne for eksempel være at man skal kombinere to forskellige informationer, eller at man skal kombinere en information med sund fornuft.
+        Overvej derfor grundigt hvilke spørgsmål som er udfordrende nok. Det er ikke nok bare at spørge direkte om fakta.
+        Formater outputtet som en JSON liste af `dict`s, hvor hver `dict` indeholder en 'spørgsmål' og en 'svar' nøgle.
+
+        Titel: {title}
+        Indhold: {content}
+
+        Tænk først over hvilke spørgsmål som kunne være udfordrende og interessante nok. Skriv din begrundelse kort, en sætning per spørgsmål. Skriv derefter JSON listen af `dict`s. Der skal være 3 spørgsmål. Sørg for at alle genererede spørgsmål og svar er på dansk.
+        """
+SOFT_PROMPT = """
+        Givet følgende Wikipedia-artikel, skal du generere 5 spørgsmål og deres svar baseret på indholdet. 
+        Svaret skal stå direkte i den givne artikel, uden brug af anden viden. Svaret skal være kort, gerne kun 1 til 2 ord eller et tal.
+        Spørgsmålet må gerne være svært, og omformuler gerne ord i teksten.
+        Formater outputtet som en liste af `dict`s, hvor hver `dict` indeholder en 'spørgsmål' og en 'svar' nøgle.
+
+        Titel: {title}
+        Indhold: {content}
+
+        Output kun listen af `dict`s, uden yderligere tekst. Sørg for at både spørgsmål og svar er på dansk.
+        """
+
 def process_article(title, text):
     logging.debug(f"Processing article: {title}")
     if is_redirect(text):
         logging.info(f"Article {title} is a redirect, skipping")
         return None
+    if is_trivially_rejectable(text):
+        logging.info(f"Article {title} is too short, skipping")
+        return None
     try:
         wikicode = mwparserfromhell.parse(text)
     except Exception as e:
@@ -44,170 +122,260 @@ def process_article(title, text):
     logging.debug(f"Processed article: {title}")
     return {"title": title, "content": content}
 
+def is_trivially_rejectable(text):
+    # Cleaning only removes text, so raw text below the size thresholds can
+    # never become meaningful
+    if len(text) < MIN_CONTENT_LENGTH:
+        return True
+    return len(text.split()) < MIN_WORD_COUNT
+
 def is_meaningful_article(content):
-    min_content_length = 500
-    min_word_count = 70
-    
     word_count = len(content.split())
     
-    return len(content) >= min_content_length and word_count >= min_word_count
+    return len(content) >= MIN_CONTENT_LENGTH and word_count >= MIN_WORD_COUNT
 
 def is_include_only(content):
     # Remove any leading whitespace and newlines
     content = content.lstrip()
 
     # Check if the content starts with common 'include only' patterns
-    include_only_starts = [
+    include_only_starts = (
         '}',  # Closing bracket of a template
         '|',  # Parameter separator in a template
         '</'  # Closing tag
-    ]
+    )
 
-    if any(content.startswith(start) for start in include_only_starts):
+    if content.startswith(include_only_starts):
         return True
 
     # Check if the content consists only of templates, categories, and whitespace
-    cleaned_content = re.sub(r'{{[^}]*}}|\[\[Kategori:[^\]]*\]\]|\s', '', content)
-    if not cleaned_content:
+    if _RE_ONLY_TEMPLATES_AND_CATS.fullmatch(content):
         return True
 
-    # Check for specific 'include only' templates
-    include_only_templates = [
-        r'{{\s*(?:Include only|Kun til inklusion)',
-        r'{{\s*(?:navbox|infoboks|Infoboks)',
-        r'{{\s*(?:tabel|Table)',
-    ]
-
-    for template in include_only_templates:
-        if re.search(template, content, re.IGNORECASE):
-            # Check if this template is the main content of the article
-            template_ratio = len(re.findall(template, content, re.IGNORECASE)) / len(content.split())
-            if template_ratio > 0.8:  # If more than 80% of the words are part of these templates
-                return True
-
-    return False
-
+    # Check for specific 'include only' templates, counted per kind in a single pass
+    template_counts = {}
+    for match in _RE_INCLUDE_ONLY_TEMPLATES.finditer(content):
+        template_counts[match.lastgroup] = template_counts.get(match.lastgroup, 0) + 1
+    if not template_counts:
+        return False
 
-def generate_questions(article, cache_dir, hard: bool):
+    # Check if one of these templates is the main content of the article
+    word_count = len(content.split())
+    # If more than 80% of the words are part of these templates
+    return max(template_counts.values()) / word_count > 0.8
+
+
+def article_cache_key(article):
+    # Only the content sent to the model is hashed. Not security sensitive, the
+    # NUL bytes separate the fields
+    h = hashlib.blake2b(digest_size=16, usedforsecurity=False)
+    h.update(PROMPT_VERSION.encode())
+    h.update(b'\x00')
+    h.update(article['title'].encode())
+    h.update(b'\x00')
+    h.update(article['content'][:MAX_CONTENT_CHARS].encode())
+    return h.hexdigest()
+
+async def generate_questions(article, cache, hard: bool, semantic_cache=None):
     logging.debug(f"Generating questions for article: {article['title']}")
-    article_hash = hashlib.md5((article['title'] + article['content']).encode()).hexdigest()
-    cache_file = os.path.join(cache_dir, f"{article_hash}.json")
+    article_hash = article_cache_key(article)
+
+    qa_pairs = cache.get(article_hash)
+    if qa_pairs is not None:
+        logging.debug(f"Loading cached questions for article: {article['title']}")
+        return qa_pairs
 
-    if os.path.exists(cache_file):
-        with open(cache_file, 'r', encoding='utf-8') as f:
-            logging.debug(f"Loading cached questions for article: {article['title']}")
-            return json.loads(f.read())
+    embedding = None
+    if semantic_cache is not None:
+        try:
+            embedding = await semantic_cache.embed(article)
+            similar_hash = semantic_cache.lookup(embedding)
+        except Exception as e:
+            logging.warning(f"Semantic cache lookup failed for article {article['title']}: {e}")
+            similar_hash = None
+        if similar_hash is not None:
+            qa_pairs = cache.get(similar_hash)
+            if qa_pairs is not None:
+                logging.info(f"Loading questions of a similar article for article: {article['title']}")
+                return qa_pairs
 
     if hard:
         logging.info(f"Generating hard questions for article: {article['title']}")
-        prompt = f"""
-        Givet følgende Wikipedia-artikel, skal du generere 3 spørgsmål og deres svar baseret på indholdet. 
-        Svaret skal kunne udledes fra information i artiklen, ved brug af almindelig viden og logik. Svaret skal være et par ord eller højest en kort sætning.
-        Spørgsmålene skal være udfordrende, svarene må ikke stå direkte i artiklen. Der skal gerne bruges 2-3 logiske trin til at udlede svaret.
-        Det kunne for eksempel være at man skal kombinere to forskellige informationer, eller at man skal kombinere en information med sund fornuft.
-        Overvej derfor grundigt hvilke spørgsmål som er udfordrende nok. Det er ikke nok bare at spørge direkte om fakta.
-        Formater outputtet som en JSON liste af `dict`s, hvor hver `dict` indeholder en 'spørgsmål' og en 'svar' nøgle.
-
-        Titel: {article['title']}
-        Indhold: {article['content'][:8000]}
-
-        Tænk først over hvilke spørgsmål som kunne være udfordrende og interessante nok. Skriv din begrundelse kort, en sætning per spørgsmål. Skriv derefter JSON listen af `dict`s. Der skal være 3 spørgsmål. Sørg for at alle genererede spørgsmål og svar er på dansk.
-        """
+        prompt_template = HARD_PROMPT
     else:
         logging.info(f"Generating soft questions for article: {article['title']}")
-        prompt = f"""
-        Givet følgende Wikipedia-artikel, skal du generere 5 spørgsmål og deres svar baseret på indholdet. 
-        Svaret skal stå direkte i den givne artikel, uden brug af anden viden. Svaret skal være kort, gerne kun 1 til 2 ord eller et tal.
-        Spørgsmålet må gerne være svært, og omformuler gerne ord i teksten.
-        Formater outputtet som en liste af `dict`s, hvor hver `dict` indeholder en 'spørgsmål' og en 'svar' nøgle.
-
-        Titel: {article['title']}
-        Indhold: {article['content'][:8000]}
-
-        Output kun listen af `dict`s, uden yderligere tekst. Sørg for at både spørgsmål og svar er på dansk.
-        """
+        prompt_template = SOFT_PROMPT
+    messages = [
+        SYSTEM_MESSAGE,
+        {"role": "user", "content": prompt_template.format_map({"title": article['title'], "content": article['content'][:MAX_CONTENT_CHARS]})},
+    ]
 
-    max_retries = 3
+    max_retries = 6
     for attempt in range(max_retries):
         try:
             logging.debug(f"Sending API request for article: {article['title']} (Attempt {attempt + 1})")
-            response = client.chat.completions.create(
+            response = await client.chat.completions.create(
                 model="gpt-4o",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant that generates questions and answers based on given content in Danish."},
-                    {"role": "user", "content": prompt}
-                ],
+                messages=messages,
                 temperature=0.7,
             )
             if response.choices[0].message.content is None:
                 raise ValueError("Empty response from API")
 
             logging.info(f"Response from API: {response.choices[0].message.content}")
-            json_matches = re.findall(r'\[.*?\]', response.choices[0].message.content, re.DOTALL)
+            json_matches = _RE_JSON_LIST.findall(response.choices[0].message.content)
             logging.info(json_matches)
-            qa_pairs = json.loads(json_matches[0])
+            qa_pairs = orjson.loads(json_matches[0])
             assert type(qa_pairs) == list
             logging.info(qa_pairs)
 
-            with open(cache_file, 'w', encoding='utf-8') as f:
-                f.write(json.dumps(qa_pairs, ensure_ascii=False, indent=2))
+            cache.set(article_hash, qa_pairs)
+            if embedding is not None:
+                # The questions are already cached, so a failure here must not
+                # trigger another request
+                try:
+                    semantic_cache.add(embedding, article_hash)
+                except Exception as e:
+                    logging.warning(f"Failed to add article {article['title']} to the semantic cache: {e}")
 
             logging.debug(f"Generated and cached questions for article: {article['title']}")
             return qa_pairs
         except Exception as e:
+            if not is_retryable(e):
+                logging.error(f"Non-retryable error while generating Q&A pairs for article {article['title']}: {e}")
+                return []
             logging.warning(f"Error occurred while generating Q&A pairs: {e}")
             if attempt < max_retries - 1:
-                time.sleep(2)
+                await asyncio.sleep(retry_delay(e, attempt))
     
     logging.error(f"Failed to generate Q&A pairs after {max_retries} attempts for article: {article['title']}")
     return []
 
+def is_retryable(error):
+    # Client errors such as a bad API key or an invalid request fail the same way
+    # on every attempt. Rate limits, server errors, connection errors and
+    # unparsable output are retried
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return True
+
+def retry_delay(error, attempt, max_delay=60):
+    # Honor the Retry-After header of rate limit and server errors, otherwise
+    # back off exponentially with full jitter
+    response = getattr(error, 'response', None)
+    if response is not None:
+        retry_after = response.headers.get('retry-after')
+        if retry_after is not None:
+            try:
+                return min(float(retry_after), max_delay)
+            except ValueError:
+                pass
+    return random.uniform(0, min(2 ** (attempt + 1), max_delay))
+
 def clean_wikitext(text):
-    text = re.sub(r'{{[^}]*}}', '', text)
-    text = re.sub(r'\[\[Kategori:[^\]]*\]\]', '', text)
-    text = re.sub(r'\[http[^\]]*\]', '', text)
-    text = re.sub(r'<!--.*?-->', '', text, flags=re.DOTALL)
-    text = re.sub(r'<ref[^>]*>.*?</ref>', '', text, flags=re.DOTALL)
-    text = re.sub(r'\[\[(?:[^|\]]*\|)?([^\]]+)\]\]', r'\1', text)
+    text = _RE_STRIP.sub('', text)
+    text = _RE_WIKILINK.sub(r'\1', text)
     return text.strip()
 
 def is_redirect(text):
     return text.strip().lower().startswith('#redirect')
 
-def process_articles(db_path, article_ids, cache_dir, hard: bool):
-    conn = sqlite3.connect(db_path)
+def select_articles(cursor, article_ids):
+    # Sorted ids make SQLite walk the articles B-tree forward instead of seeking
+    # around it. SQLite limits the number of bound parameters, so large
+    # selections go through a temporary table instead of an IN clause
+    sorted_ids = sorted(article_ids)
+    if len(sorted_ids) < 900:
+        placeholders = ','.join('?' * len(sorted_ids))
+        return cursor.execute(f'SELECT id, title, content FROM articles WHERE id IN ({placeholders}) ORDER BY id', sorted_ids)
+
+    cursor.execute('CREATE TEMP TABLE IF NOT EXISTS sel (id INTEGER PRIMARY KEY)')
+    cursor.execute('DELETE FROM sel')
+    cursor.executemany('INSERT OR IGNORE INTO sel (id) VALUES (?)', ((article_id,) for article_id in sorted_ids))
+    return cursor.execute('SELECT a.id, a.title, a.content FROM sel JOIN articles a USING (id) ORDER BY id')
+
+def connect_readonly(db_path):
+    conn = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    conn.execute('PRAGMA mmap_size=30000000000')
+    conn.execute('PRAGMA cache_size=-262144')
+    conn.execute('PRAGMA temp_store=MEMORY')
+    return conn
+
+async def process_articles_async(db_path, article_ids, cache, output_path, hard: bool, max_concurrency=32, semantic_cache=None):
+    conn = connect_readonly(db_path)
     cursor = conn.cursor()
 
-    dataset = datasets.Dataset.from_dict({"title": [], "context": [], "question": [], "answer": []})
+    rows = {"title": [], "context": [], "question": [], "answer": []}
+    semaphore = asyncio.Semaphore(max_concurrency)
+    # Articles are read in windows of this many ids, and at most this many
+    # articles wait to be written, which bounds memory use
+    window = 4 * max_concurrency
+    pending = collections.deque()
+
+    with tqdm(total=len(article_ids), desc="Processing articles") as pbar, \
+            pq.ParquetWriter(output_path, QA_SCHEMA) as writer:
+        async def generate(article):
+            async with semaphore:
+                qa_pairs = await generate_questions(article, cache, hard, semantic_cache)
+            pbar.update(1)
+            return qa_pairs
 
-    with tqdm(total=len(article_ids), desc="Processing articles") as pbar:
-        for article_id in article_ids:
-            cursor.execute('SELECT title, content FROM articles WHERE id = ?', (article_id,))
-            result = cursor.fetchone()
-            if result:
-                title, text = result
+        async def write_next():
+            task, article = pending.popleft()
+            for qa in await task:
+                rows["title"].append(article["title"])
+                rows["context"].append(article["content"])
+                rows["question"].append(qa["spørgsmål"])
+                rows["answer"].append(qa["svar"])
+            if len(rows["title"]) >= WRITE_BATCH_SIZE:
+                write_rows(writer, rows)
+
+        for start in range(0, len(article_ids), window):
+            window_ids = article_ids[start:start + window]
+            articles = {}
+            rows_read = 0
+            for article_id, title, text in select_articles(cursor, window_ids):
+                rows_read += 1
                 article = process_article(title, text)
                 if article:
-                    qa_pairs = generate_questions(article, cache_dir, hard)
-                    for qa in qa_pairs:
-                        qa_entry = {
-                            "title": title,
-                            "context": article["content"],
-                            "question": qa["spørgsmål"],
-                            "answer": qa["svar"]
-                        }
-                        dataset = dataset.add_item(qa_entry)
-                pbar.update(1)
+                    articles[article_id] = article
+                else:
+                    pbar.update(1)
+                # Let the pending API requests make progress while reading
+                await asyncio.sleep(0)
+            # Account for ids that are not in the database
+            pbar.update(len(window_ids) - rows_read)
+
+            # Queue and write in the order of the given ids to keep the dataset
+            # deterministic
+            for article_id in window_ids:
+                if article_id in articles:
+                    article = articles[article_id]
+                    pending.append((asyncio.create_task(generate(article)), article))
+            while len(pending) > window:
+                await write_next()
+
+        while pending:
+            await write_next()
+        write_rows(writer, rows)
 
     conn.close()
-    return dataset
+    return datasets.Dataset.from_parquet(output_path)
+
+def process_articles(db_path, article_ids, cache, output_path, hard: bool, max_concurrency=32, semantic_cache=None):
+    return asyncio.run(process_articles_async(db_path, article_ids, cache, output_path, hard, max_concurrency, semantic_cache))
+
+def write_rows(writer, rows):
+    writer.write_batch(pa.RecordBatch.from_pydict(rows, schema=QA_SCHEMA))
+    for column in rows.values():
+        column.clear()
 
 def main(args):
     db_path = "danish_wikipedia.db"
     cache_dir = "qa_cache_hard" if args.hard else "qa_cache"
     os.makedirs(cache_dir, exist_ok=True)
 
-    conn = sqlite3.connect(db_path)
+    conn = connect_readonly(db_path)
     cursor = conn.cursor()
     
     cursor.execute('SELECT COUNT(*) FROM articles')
@@ -221,9 +389,17 @@ def main(args):
 
     conn.close()
 
-    dataset = process_articles(db_path, selected_article_ids, cache_dir, args.hard)
+    cache = QACache(os.path.join(cache_dir, "qa_cache.sqlite"))
+    semantic_cache = SemanticCache(cache_dir, client, threshold=args.semantic_threshold) if args.semantic_cache else None
+    output_name = "daqa-hard" if args.hard else "daqa"
+    try:
+        dataset = process_articles(db_path, selected_article_ids, cache, f"{output_name}.parquet", args.hard, args.concurrency, semantic_cache)
+    finally:
+        cache.close()
+        if semantic_cache is not None:
+            semantic_cache.close()
 
-    dataset.save_to_disk("daqa-hard" if args.hard else "daqa")
+    dataset.save_to_disk(output_name)
 
     if args.upload:
         api = HfApi()
@@ -242,6 +418,9 @@ if __name__ == "__main__":
     parser.add_argument("--upload", action="store_true", help="Upload the dataset to Hugging Face Hub")
     parser.add_argument("--repo-id", type=str, help="Hugging Face Hub repository ID for uploading")
     parser.add_argument("--hard", action="store_true", help="Use hard prompt for generating questions")
+    parser.add_argument("--semantic-cache", action="store_true", help="Reuse questions of near-duplicate articles based on embedding similarity")
+    parser.add_argument("--semantic-threshold", type=float, default=0.95, help="Minimum cosine similarity for a semantic cache hit")
+    parser.add_argument("--concurrency", type=int, default=32, help="Number of concurrent OpenAI API requests")
     args = parser.parse_args()
 
     if args.upload and not args.repo_id:
@@ -0,0 +1,32 @@
+import sqlite3
+
+import orjson
+import zstandard
+
+
+# Generated Q&A pairs keyed on the article cache key, stored as zstd-compressed
+# JSON in a single SQLite table.
+class QACache:
+    def __init__(self, path, level=3):
+        self.compressor = zstandard.ZstdCompressor(level=level)
+        self.decompressor = zstandard.ZstdDecompressor()
+
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS cache (hash TEXT PRIMARY KEY, payload BLOB)')
+        self.conn.commit()
+
+    def get(self, key):
+        result = self.conn.execute('SELECT payload FROM cache WHERE hash = ?', (key,)).fetchone()
+        if result is None:
+            return None
+        return orjson.loads(self.decompressor.decompress(result[0]))
+
+    def set(self, key, qa_pairs):
+        payload = self.compressor.compress(orjson.dumps(qa_pairs))
+        self.conn.execute('INSERT OR REPLACE INTO cache (hash, payload) VALUES (?, ?)', (key, payload))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
@@ -0,0 +1,65 @@
+import logging
+import os
+import sqlite3
+
+import faiss
+import numpy as np
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_DIM = 1536
+
+
+# Maps articles to the cache key of a previously generated near-duplicate. The
+# embeddings are kept in a FAISS inner-product index, and a SQLite sidecar maps
+# each index row to the cache key of the article it was computed from.
+class SemanticCache:
+    def __init__(self, cache_dir, client, threshold=0.95, max_chars=2000):
+        self.client = client
+        self.threshold = threshold
+        self.max_chars = max_chars
+        self.index_path = os.path.join(cache_dir, "index.faiss")
+
+        if os.path.exists(self.index_path):
+            self.index = faiss.read_index(self.index_path)
+        else:
+            self.index = faiss.IndexFlatIP(EMBEDDING_DIM)
+
+        self.conn = sqlite3.connect(os.path.join(cache_dir, "index.sqlite"))
+        self.conn.execute('CREATE TABLE IF NOT EXISTS entries (row INTEGER PRIMARY KEY, hash TEXT)')
+        # Rows added after the index was last saved have no embedding, drop them
+        self.conn.execute('DELETE FROM entries WHERE row >= ?', (self.index.ntotal,))
+        self.conn.commit()
+
+    async def embed(self, article):
+        response = await self.client.embeddings.create(
+            model=EMBEDDING_MODEL,
+            input=f"{article['title']}\n{article['content'][:self.max_chars]}",
+        )
+        embedding = np.asarray([response.data[0].embedding], dtype=np.float32)
+        faiss.normalize_L2(embedding)
+        return embedding
+
+    def lookup(self, embedding):
+        if self.index.ntotal == 0:
+            return None
+        scores, rows = self.index.search(embedding, 1)
+        if scores[0][0] < self.threshold:
+            return None
+        result = self.conn.execute('SELECT hash FROM entries WHERE row = ?', (int(rows[0][0]),)).fetchone()
+        if result is None:
+            return None
+        logging.debug(f"Semantic cache hit with similarity {scores[0][0]:.3f}")
+        return result[0]
+
+    def add(self, embedding, article_hash):
+        row = self.index.ntotal
+        self.index.add(embedding)
+        self.conn.execute('INSERT OR REPLACE INTO entries (row, hash) VALUES (?, ?)', (row, article_hash))
+        self.conn.commit()
+
+    def save(self):
+        faiss.write_index(self.index, self.index_path)
+
+    def close(self):
+        self.save()
+        self.conn.close()